@@ -15,16 +15,39 @@ Usage:
 
 import sys
 import os
+import io
 import getpass
 import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import shutil
 import requests
 import configparser
-import xml.etree.ElementTree as ET
+import threading
+import traceback
 import grp
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
 from typing import List, Optional
 
+# Maximum pooled connections (and worker threads) for Nextcloud API calls
+API_POOL_SIZE = 16
+
+# Number of users requested per page when listing all Nextcloud users
+USER_PAGE_SIZE = 200
+
+# Print tracebacks for unexpected errors (set by --debug)
+DEBUG = False
+
+# Prefer lxml's C parser for OCS XML responses when it is installed
+try:
+    from lxml import etree as ET
+    HAS_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAS_LXML = False
+
 # Try to import pwd for user checking
 try:
     import pwd
@@ -41,6 +64,132 @@ except ImportError:
     GroupSync = None
 
 
+# Shared HTTP session for all Nextcloud API calls (created on first use)
+_session = None
+
+
+def _get_session():
+    """Return the shared HTTP session for Nextcloud API calls
+    
+    Connections are kept alive and pooled, so the many per-group and
+    per-user requests of a sync run share a few TLS handshakes instead of
+    paying one each. Idempotent GETs are retried on connection errors.
+    """
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.headers.update({
+            'OCS-APIRequest': 'true',
+            'Accept': 'application/json'
+        })
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=API_POOL_SIZE,
+            max_retries=Retry(total=3, backoff_factor=0.3)
+        )
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+# lxml parsers and compiled XPath objects must not be shared between threads
+_xml_local = threading.local()
+
+
+def _xml_fromstring(content):
+    """Parse an OCS XML response body
+    
+    With lxml, a per-thread parser is used that never resolves entities or
+    fetches external resources, since the body comes from the network.
+    """
+    if not HAS_LXML:
+        return ET.fromstring(content)
+    parser = getattr(_xml_local, 'parser', None)
+    if parser is None:
+        parser = ET.XMLParser(resolve_entities=False, no_network=True)
+        _xml_local.parser = parser
+    return ET.fromstring(content, parser)
+
+
+def _ocs_elements(root, key):
+    """Return the <element> nodes of ocs.data.<key> in a parsed OCS document
+    
+    With lxml the path is compiled to an XPath object once per thread;
+    the standard library caches compiled findall paths itself.
+    """
+    path = f'.//data/{key}/element'
+    if not HAS_LXML:
+        return root.findall(path)
+    xpaths = getattr(_xml_local, 'xpaths', None)
+    if xpaths is None:
+        xpaths = _xml_local.xpaths = {}
+    xpath = xpaths.get(key)
+    if xpath is None:
+        xpath = xpaths[key] = ET.XPath(path)
+    return xpath(root)
+
+
+def _parse_ocs_list(response, key):
+    """Extract a list of names from an OCS response
+    
+    The body is parsed once, as JSON or XML according to its Content-Type.
+    Only a body with no usable Content-Type is tried as JSON and then XML.
+    
+    Args:
+        response: requests.Response from an OCS endpoint
+        key: Name of the list under ocs.data (e.g. 'users' or 'groups')
+        
+    Returns:
+        List of names (possibly empty), or None if the body could not be parsed
+    """
+    content_type = response.headers.get('Content-Type', '')
+    
+    if 'xml' not in content_type:
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and isinstance(data.get('ocs'), dict) and 'data' in data['ocs']:
+            ocs_data = data['ocs']['data']
+            items = ocs_data.get(key, []) if isinstance(ocs_data, dict) else []
+            if isinstance(items, dict):
+                items = items.get('element', [])
+            if isinstance(items, str):
+                return [items] if items else []
+            return items if isinstance(items, list) else []
+        if 'json' in content_type:
+            return None
+    
+    try:
+        root = _xml_fromstring(response.content)
+    except ET.ParseError:
+        return None
+    return [element.text for element in _ocs_elements(root, key) if element.text]
+
+
+def _ensure_dir(path, mode=0o755):
+    """Create a directory (and missing parents) without probing first
+    
+    mkdir is attempted directly; an existing directory is the common case
+    and costs a single failed syscall. Parents are only walked when the
+    kernel reports that one is missing.
+    """
+    try:
+        os.mkdir(path, mode)
+    except FileExistsError:
+        if not os.path.isdir(path):
+            raise
+    except FileNotFoundError:
+        parent = os.path.dirname(path.rstrip('/'))
+        if not parent or parent == path:
+            raise
+        _ensure_dir(parent, mode)
+        try:
+            os.mkdir(path, mode)
+        except FileExistsError:
+            pass
+
+
 def get_config(config_path='/etc/security/pam_nextcloud.conf'):
     """Load configuration from file"""
     if not os.path.exists(config_path):
@@ -83,36 +232,15 @@ def get_all_nextcloud_groups(admin_username, admin_password, config):
     try:
         api_url = urljoin(config['url'], '/ocs/v2.php/cloud/groups')
         
-        response = requests.get(
+        response = _get_session().get(
             api_url,
             auth=(admin_username, admin_password),
-            headers={
-                'OCS-APIRequest': 'true',
-                'Accept': 'application/json'
-            },
             verify=config['verify_ssl'],
             timeout=config['timeout']
         )
         
         if response.status_code == 200:
-            try:
-                data = response.json()
-                if 'ocs' in data and 'data' in data['ocs']:
-                    groups_data = data['ocs']['data'].get('groups', {})
-                    
-                    if isinstance(groups_data, dict) and 'element' in groups_data:
-                        elements = groups_data['element']
-                        return elements if isinstance(elements, list) else [elements]
-                    elif isinstance(groups_data, list):
-                        return groups_data
-            except (ValueError, KeyError):
-                # Try XML
-                root = ET.fromstring(response.content)
-                groups = []
-                for element in root.findall('.//data/groups/element'):
-                    if element.text:
-                        groups.append(element.text)
-                return groups
+            return _parse_ocs_list(response, 'groups') or []
         
         return []
     except Exception as e:
@@ -131,85 +259,72 @@ def get_local_groups():
         return []
 
 
-def get_group_members(admin_username, admin_password, group_name, config):
-    """Get list of users in a Nextcloud group"""
+def get_group_members(admin_username, admin_password, group_name, config, local_only=False):
+    """Get list of users in a Nextcloud group
+    
+    If the group's member list cannot be read, every Nextcloud user's groups
+    are checked instead. With local_only, that fallback only checks users
+    that exist locally, for callers that discard everyone else anyway.
+    """
     try:
         api_url = urljoin(config['url'], f'/ocs/v2.php/cloud/groups/{group_name}/users')
         
-        response = requests.get(
+        response = _get_session().get(
             api_url,
             auth=(admin_username, admin_password),
-            headers={
-                'OCS-APIRequest': 'true',
-                'Accept': 'application/json'
-            },
             verify=config['verify_ssl'],
             timeout=config['timeout']
         )
         
         if response.status_code == 200:
-            users = None
-            try:
-                data = response.json()
-                if 'ocs' in data and 'data' in data['ocs']:
-                    users_data = data['ocs']['data'].get('users', {})
-                    
-                    if isinstance(users_data, list):
-                        users = users_data
-                    elif isinstance(users_data, dict) and 'element' in users_data:
-                        element = users_data['element']
-                        users = element if isinstance(element, list) else [element]
-                    elif isinstance(users_data, str):
-                        users = [users_data] if users_data else []
-            except (ValueError, KeyError):
-                pass
-            
-            if not users:
-                root = ET.fromstring(response.content)
-                users = []
-                for element in root.findall('.//data/users/element'):
-                    if element.text:
-                        users.append(element.text)
+            users = _parse_ocs_list(response, 'users')
             
+            # An empty group is a valid answer; only fall back when the
+            # response could not be parsed at all
             if users is not None:
                 return users
             
-            # Fallback: Get all users and check their groups
+            # Fallback: Get all users (one page at a time) and check their groups
             api_url = urljoin(config['url'], '/ocs/v2.php/cloud/users')
-            response = requests.get(
-                api_url,
-                auth=(admin_username, admin_password),
-                headers={
-                    'OCS-APIRequest': 'true',
-                    'Accept': 'application/json'
-                },
-                verify=config['verify_ssl'],
-                timeout=config['timeout']
-            )
-            
-            if response.status_code == 200:
-                all_users = []
-                try:
-                    data = response.json()
-                    if 'ocs' in data and 'data' in data['ocs']:
-                        users_data = data['ocs']['data'].get('users', {})
-                        if isinstance(users_data, dict) and 'element' in users_data:
-                            all_users = users_data['element'] if isinstance(users_data['element'], list) else [users_data['element']]
-                        elif isinstance(users_data, list):
-                            all_users = users_data
-                except (ValueError, KeyError):
-                    pass
+            all_users = []
+            offset = 0
+            while True:
+                response = _get_session().get(
+                    api_url,
+                    params={'limit': USER_PAGE_SIZE, 'offset': offset},
+                    auth=(admin_username, admin_password),
+                    verify=config['verify_ssl'],
+                    timeout=config['timeout']
+                )
+                if response.status_code != 200:
+                    break
                 
-                group_members = []
-                for user in all_users:
-                    user_groups = get_user_groups(admin_username, admin_password, user, config)
-                    if user_groups and group_name in user_groups:
-                        group_members.append(user)
-                return group_members
+                page = _parse_ocs_list(response, 'users') or []
+                all_users.extend(page)
+                if len(page) < USER_PAGE_SIZE:
+                    break
+                offset += USER_PAGE_SIZE
+            
+            if local_only:
+                all_users = [user for user in all_users if user_exists(user)]
+            
+            if all_users:
+                # Query users concurrently over the pooled session
+                with ThreadPoolExecutor(max_workers=API_POOL_SIZE) as executor:
+                    all_user_groups = executor.map(
+                        lambda user: get_user_groups(admin_username, admin_password, user, config),
+                        all_users
+                    )
+                    return [
+                        user for user, user_groups in zip(all_users, all_user_groups)
+                        if user_groups and group_name in user_groups
+                    ]
         
         return []
     except Exception as e:
         print(f"⚠️  Error getting group members: {e}")
+        if DEBUG:
+            traceback.print_exc()
         return []
 
 
@@ -218,13 +333,9 @@ def get_user_details(admin_username, admin_password, username, config):
     try:
         api_url = urljoin(config['url'], f'/ocs/v2.php/cloud/users/{username}')
         
-        response = requests.get(
+        response = _get_session().get(
             api_url,
             auth=(admin_username, admin_password),
-            headers={
-                'OCS-APIRequest': 'true',
-                'Accept': 'application/json'
-            },
             verify=config['verify_ssl'],
             timeout=config['timeout']
         )
@@ -257,7 +368,7 @@ def get_user_details(admin_username, admin_password, username, config):
             except (ValueError, KeyError) as e:
                 # Try XML parsing
                 try:
-                    root = ET.fromstring(response.content)
+                    root = _xml_fromstring(response.content)
                     display_name_elem = root.find('.//displayname')
                     if display_name_elem is not None and display_name_elem.text:
                         return {'display_name': display_name_elem.text}
@@ -270,38 +381,34 @@ def get_user_details(admin_username, admin_password, username, config):
         return {}
 
 
+# Group lists fetched by get_user_groups during this run, keyed by username
+_user_groups_cache = {}
+
+
 def get_user_groups(admin_username, admin_password, username, config):
-    """Get list of groups a user belongs to"""
+    """Get list of groups a user belongs to
+    
+    Successful lookups are cached for the rest of the run, so the
+    all-users fallback of get_group_members does not query the same user
+    again for every group being synced.
+    """
+    if username in _user_groups_cache:
+        return _user_groups_cache[username]
+    
     try:
         api_url = urljoin(config['url'], f'/ocs/v2.php/cloud/users/{username}/groups')
         
-        response = requests.get(
+        response = _get_session().get(
             api_url,
             auth=(admin_username, admin_password),
-            headers={
-                'OCS-APIRequest': 'true',
-                'Accept': 'application/json'
-            },
             verify=config['verify_ssl'],
             timeout=config['timeout']
         )
         
         if response.status_code == 200:
-            try:
-                data = response.json()
-                if 'ocs' in data and 'data' in data['ocs']:
-                    groups = data['ocs']['data'].get('groups', {})
-                    if isinstance(groups, dict) and 'element' in groups:
-                        group_list = groups['element']
-                        return group_list if isinstance(group_list, list) else [group_list]
-                    elif isinstance(groups, list):
-                        return groups
-            except (ValueError, KeyError):
-                root = ET.fromstring(response.content)
-                groups = []
-                for element in root.findall('.//data/groups/element'):
-                    if element.text:
-                        groups.append(element.text)
+            groups = _parse_ocs_list(response, 'groups')
+            if groups is not None:
+                _user_groups_cache[username] = groups
                 return groups
         return []
     except Exception:
@@ -317,21 +424,69 @@ def get_local_group_members(group_name):
         return []
 
 
+# Local usernames, loaded once per run (see _get_local_users)
+_local_users = None
+
+# Usernames confirmed absent by an individual lookup during this run
+_missing_users = set()
+
+
+def _get_local_users():
+    """Return the set of local usernames, reading the passwd database once
+    
+    A sync run checks the same users several times; a single scan replaces
+    a getpwnam lookup (or a getent fork) per check. The set is only a
+    positive cache: with SSSD/LDAP and enumeration off, directory users are
+    missing from it, so user_exists confirms misses individually. Users
+    created by this script are added to the set by create_user.
+    """
+    global _local_users
+    if _local_users is None:
+        try:
+            if pwd:
+                _local_users = {entry.pw_name for entry in pwd.getpwall()}
+            else:
+                result = subprocess.run(
+                    ['getent', 'passwd'],
+                    capture_output=True,
+                    text=True,
+                    check=False
+                )
+                _local_users = {
+                    line.split(':', 1)[0] for line in result.stdout.splitlines() if line
+                }
+        except Exception:
+            _local_users = set()
+    return _local_users
+
+
 def user_exists(username):
     """Check if a local user exists"""
+    local_users = _get_local_users()
+    if username in local_users:
+        return True
+    if username in _missing_users:
+        return False
+    
     try:
         if pwd:
             pwd.getpwnam(username)
-            return True
+            found = True
         else:
             result = subprocess.run(
                 ['getent', 'passwd', username],
                 capture_output=True,
                 check=False
             )
-            return result.returncode == 0
+            found = result.returncode == 0
     except (KeyError, Exception):
-        return False
+        found = False
+    
+    if found:
+        local_users.add(username)
+    else:
+        _missing_users.add(username)
+    return found
 
 
 def lock_local_password(username):
@@ -445,65 +600,71 @@ def lock_local_password(username):
         return False
 
 
+# GDM dconf settings that make the login screen list users
+GDM_USER_LIST_SETTINGS = '[org/gnome/login-screen]\ndisable-user-list=false\n'
+GDM_USER_LIST_LOCK = '/org/gnome/login-screen/disable-user-list\n'
+
+
+def _file_has_content(path, content):
+    """Check whether a file exists with exactly the given content"""
+    try:
+        with open(path, 'r') as f:
+            return f.read() == content
+    except OSError:
+        return False
+
+
+def _is_newer(path, *sources):
+    """Check whether path exists and was modified after all the sources"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        return all(mtime > os.stat(source).st_mtime_ns for source in sources)
+    except OSError:
+        return False
+
+
 def configure_gdm_user_list():
     """Configure GDM to show user list on login screen"""
     try:
-        # Check if GDM is installed
-        gdm_check = subprocess.run(
-            ['systemctl', 'is-enabled', 'gdm'],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        
-        # Also check if gdm.service exists
-        gdm_service_check = subprocess.run(
-            ['systemctl', 'list-unit-files', 'gdm.service'],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        
         # Check if dconf is available (needed for GDM config)
-        dconf_check = subprocess.run(
-            ['which', 'dconf'],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        
-        if dconf_check.returncode != 0:
+        if shutil.which('dconf') is None:
             # dconf not available, skip GDM configuration
             return False
         
         # Create GDM configuration directory
         gdm_db_dir = '/etc/dconf/db/gdm.d'
         gdm_lock_dir = '/etc/dconf/db/gdm.d/locks'
+        config_file = os.path.join(gdm_db_dir, '00-show-user-list')
+        lock_file = os.path.join(gdm_lock_dir, '00-show-user-list')
+        gdm_db = '/etc/dconf/db/gdm'
         
-        try:
-            os.makedirs(gdm_db_dir, mode=0o755, exist_ok=True)
-            os.makedirs(gdm_lock_dir, mode=0o755, exist_ok=True)
-        except Exception:
-            return False
+        files_current = (_file_has_content(config_file, GDM_USER_LIST_SETTINGS) and
+                         _file_has_content(lock_file, GDM_USER_LIST_LOCK))
         
-        # Create configuration file
-        config_file = os.path.join(gdm_db_dir, '00-show-user-list')
-        try:
-            with open(config_file, 'w') as f:
-                f.write('[org/gnome/login-screen]\n')
-                f.write('disable-user-list=false\n')
-            os.chmod(config_file, 0o644)
-        except Exception:
-            return False
+        # Already configured and compiled by a previous run: skip the
+        # rewrites and the 'dconf update' fork. If the compiled database is
+        # missing or older (e.g. an earlier update failed), still run it.
+        if files_current and _is_newer(gdm_db, config_file, lock_file):
+            return True
         
-        # Create lock file to prevent user override
-        lock_file = os.path.join(gdm_lock_dir, '00-show-user-list')
-        try:
-            with open(lock_file, 'w') as f:
-                f.write('/org/gnome/login-screen/disable-user-list\n')
-            os.chmod(lock_file, 0o644)
-        except Exception:
-            pass  # Lock file is optional
+        if not files_current:
+            try:
+                # Creating the locks directory also creates gdm.d if needed
+                _ensure_dir(gdm_lock_dir, 0o755)
+            except Exception:
+                return False
+            
+            # Create configuration file
+            try:
+                _write_root_file(config_file, GDM_USER_LIST_SETTINGS)
+            except Exception:
+                return False
+            
+            # Create lock file to prevent user override
+            try:
+                _write_root_file(lock_file, GDM_USER_LIST_LOCK)
+            except Exception:
+                pass  # Lock file is optional
         
         # Update dconf database
         try:
@@ -521,13 +682,78 @@ def configure_gdm_user_list():
         return False
 
 
+def _write_root_file(path, content, mode=0o644):
+    """Write a root-owned file without exposing partial content
+    
+    The content is written once, into an anonymous O_TMPFILE inode that is
+    only given a name (path + '.tmp') when complete and then renamed over
+    path, so both new and existing files take the same single-write path.
+    Kernels or filesystems without O_TMPFILE (or without /proc to link it
+    through) use an ordinary temporary file instead, with a direct write as the last resort. Ownership and
+    permissions are always set on the open descriptor.
+    """
+    data = content.encode()
+    temp_file = path + '.tmp'
+    
+    def write_fd(fd):
+        os.fchmod(fd, mode)
+        os.fchown(fd, 0, 0)  # root:root
+        with os.fdopen(fd, 'wb', closefd=False) as f:
+            f.write(data)
+    
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_TMPFILE | os.O_WRONLY, mode)
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        linked = False
+        try:
+            write_fd(fd)
+            try:
+                os.link(f'/proc/self/fd/{fd}', temp_file)
+            except FileExistsError:
+                # Stale temporary file from an interrupted run
+                os.unlink(temp_file)
+                os.link(f'/proc/self/fd/{fd}', temp_file)
+            linked = True
+        except OSError:
+            pass  # e.g. /proc unavailable: use an ordinary temporary file
+        finally:
+            os.close(fd)
+        if linked:
+            try:
+                os.replace(temp_file, path)
+            except OSError:
+                os.unlink(temp_file)
+                raise
+            return
+    
+    try:
+        fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            write_fd(fd)
+        finally:
+            os.close(fd)
+        os.rename(temp_file, path)
+        return
+    except OSError:
+        pass
+    
+    # Fallback: write directly
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        write_fd(fd)
+    finally:
+        os.close(fd)
+
+
 def ensure_accounts_service_entry(username, display_name=None):
     """Ensure user has an AccountsService entry so they appear in GDM"""
     try:
         accounts_dir = '/var/lib/AccountsService/users'
         
         # Create directory if it doesn't exist
-        os.makedirs(accounts_dir, mode=0o755, exist_ok=True)
+        _ensure_dir(accounts_dir, 0o755)
         
         # Ensure directory has correct permissions (755, readable by accounts-daemon)
         # CRITICAL: Directory must be readable by accounts-daemon user
@@ -541,25 +767,21 @@ def ensure_accounts_service_entry(username, display_name=None):
         
         user_file = os.path.join(accounts_dir, username)
         
-        # Read existing config if it exists
+        # Read existing config if it exists (missing files are skipped)
         config = configparser.ConfigParser()
-        if os.path.exists(user_file):
-            config.read(user_file)
-        
-        # Set or update User section
-        if 'User' not in config:
-            config.add_section('User')
-        
-        # Ensure SystemAccount is false (so user appears in GDM)
-        config.set('User', 'SystemAccount', 'false')
+        config.read(user_file)
         
-        # Ensure AccountType is set to "desktop" (not "system")
-        # This is required for users to appear in GDM
-        config.set('User', 'AccountType', 'desktop')
+        user_settings = {
+            # Ensure SystemAccount is false (so user appears in GDM)
+            'SystemAccount': 'false',
+            # Ensure AccountType is set to "desktop" (not "system")
+            # This is required for users to appear in GDM
+            'AccountType': 'desktop',
+        }
         
         # Set real name if provided, otherwise get from passwd
         if display_name:
-            config.set('User', 'RealName', display_name)
+            user_settings['RealName'] = display_name
         else:
             # Try to get real name from GECOS field
             try:
@@ -569,36 +791,20 @@ def ensure_accounts_service_entry(username, display_name=None):
                         # Use GECOS field, but remove everything after first comma
                         gecos_name = user_info.pw_gecos.split(',')[0]
                         if gecos_name:
-                            config.set('User', 'RealName', gecos_name)
+                            user_settings['RealName'] = gecos_name
             except Exception:
                 pass
         
+        # Set or update User section in one pass
+        config.read_dict({'User': user_settings})
+        
         # Write the config file using ConfigParser with proper formatting
         # AccountsService expects a specific format
-        # Use temporary file to ensure correct permissions
-        temp_file = user_file + '.tmp'
-        try:
-            with open(temp_file, 'w') as f:
-                config.write(f)
-                # Ensure file ends with newline
-                f.write('\n')
-            
-            # Set permissions BEFORE moving to final location
-            os.chmod(temp_file, 0o644)
-            os.rename(temp_file, user_file)
-        except Exception:
-            # Fallback: write directly
-            with open(user_file, 'w') as f:
-                config.write(f)
-                f.write('\n')
-            os.chmod(user_file, 0o644)
-        
-        # Ensure final file has correct permissions and ownership
-        try:
-            os.chmod(user_file, 0o644)
-            os.chown(user_file, 0, 0)  # root:root
-        except Exception:
-            pass
+        buffer = io.StringIO()
+        config.write(buffer)
+        # Ensure file ends with newline
+        buffer.write('\n')
+        _write_root_file(user_file, buffer.getvalue())
         
         return True
     except Exception as e:
@@ -630,6 +836,8 @@ def create_user(username, display_name=None, create_home=True):
         result = subprocess.run(cmd, capture_output=True, text=True, check=False)
         
         if result.returncode == 0:
+            _get_local_users().add(username)
+            _missing_users.discard(username)
             # Create AccountsService entry so user appears in GDM
             ensure_accounts_service_entry(username, display_name)
             return True
@@ -745,9 +953,17 @@ def main():
         action='store_true',
         help='Show what would be done without actually making changes'
     )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Print tracebacks for unexpected errors'
+    )
     
     args = parser.parse_args()
     
+    global DEBUG
+    DEBUG = args.debug
+    
     # Check if running as root
     if os.geteuid() != 0:
         print("❌ ERROR: This script must be run as root (use sudo)")
@@ -950,6 +1166,15 @@ def main():
         skipped_count = 0
         failed_count = 0
         
+        # Fetch all display names up front, concurrently over the pooled session
+        display_names = {}
+        if not args.dry_run:
+            with ThreadPoolExecutor(max_workers=API_POOL_SIZE) as executor:
+                display_names = dict(zip(group_members, executor.map(
+                    lambda username: get_user_details(admin_username, admin_password, username, config).get('display_name'),
+                    group_members
+                )))
+        
         for username in sorted(group_members):
             print(f"Processing: {username}")
             
@@ -963,9 +1188,7 @@ def main():
                         print(f"  ⚠️  Warning: Could not lock local password for '{username}'")
                         print(f"     User may need to run 'passwd -l {username}' manually")
                     # Get display name for existing user
-                    display_name = None
-                    user_details = get_user_details(admin_username, admin_password, username, config)
-                    display_name = user_details.get('display_name')
+                    display_name = display_names.get(username)
                     if display_name:
                         print(f"  📝 Found display name: {display_name}")
                     # Ensure AccountsService entry exists with display name
@@ -981,8 +1204,7 @@ def main():
                 # Get user display name from Nextcloud
                 display_name = None
                 if not args.dry_run:
-                    user_details = get_user_details(admin_username, admin_password, username, config)
-                    display_name = user_details.get('display_name')
+                    display_name = display_names.get(username)
                     if display_name:
                         print(f"  📝 Found display name: {display_name}")
                     else:
@@ -1077,8 +1299,8 @@ def main():
         for nc_group, linux_group in sorted(common_groups):
             print(f"Syncing group: {nc_group} -> {linux_group}")
             
-            # Get members from Nextcloud
-            nextcloud_members = get_group_members(admin_username, admin_password, nc_group, config)
+            # Get members from Nextcloud (only local users matter here)
+            nextcloud_members = get_group_members(admin_username, admin_password, nc_group, config, local_only=True)
             
             # Get local group members
             local_members = set(get_local_group_members(linux_group))
@@ -1238,7 +1460,9 @@ if __name__ == '__main__':
         sys.exit(130)
     except Exception as e:
         print(f"❌ FATAL ERROR: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        if DEBUG:
+            traceback.print_exc()
+        else:
+            print("   Run with --debug for a full traceback")
         sys.exit(1)
 
@@ -28,10 +28,12 @@ License: MIT
 
 import sys
 import syslog
-import configparser
 import requests
+import http.cookiejar
 from urllib.parse import urljoin
+import xml.etree.ElementTree as ET
 import os
+import errno
 import hashlib
 import json
 import time
@@ -56,19 +58,28 @@ class NextcloudAuth:
         self.enable_cache = False
         self.cache_expiry_days = 7
         self.cache_directory = '/var/cache/pam_nextcloud'
+        # Shared across calls so repeated requests reuse the TLS connection.
+        # Cookies are refused: a Nextcloud session cookie from one login must
+        # never vouch for a later request carrying different credentials.
+        self.session = requests.Session()
+        self.session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
         self.load_config()
     
     def load_config(self):
         """Load configuration from file"""
         try:
-            if not os.path.exists(self.config_path):
+            # Imported here so session/account hooks never pay for it
+            import configparser
+            config = configparser.ConfigParser()
+            try:
+                with open(self.config_path, 'r') as f:
+                    config.read_file(f)
+            except FileNotFoundError:
                 syslog.syslog(syslog.LOG_ERR, 
                     f"pam_nextcloud: Config file not found: {self.config_path}")
                 return False
             
-            config = configparser.ConfigParser()
-            config.read(self.config_path)
-            
             if 'nextcloud' not in config:
                 syslog.syslog(syslog.LOG_ERR,
                     "pam_nextcloud: [nextcloud] section not found in config")
@@ -102,10 +113,12 @@ class NextcloudAuth:
     def _ensure_cache_directory(self):
         """Create cache directory with secure permissions if it doesn't exist"""
         try:
-            if not os.path.exists(self.cache_directory):
+            try:
                 os.makedirs(self.cache_directory, mode=0o700)
                 syslog.syslog(syslog.LOG_INFO,
                     f"pam_nextcloud: Created cache directory: {self.cache_directory}")
+            except FileExistsError:
+                pass
             
             # Ensure directory has correct permissions
             os.chmod(self.cache_directory, 0o700)
@@ -172,13 +185,28 @@ class NextcloudAuth:
                 'created': datetime.now().isoformat()
             }
             
-            # Write to cache file
+            # Write to a temporary file created owner read/write only, then
+            # rename over the cache file so readers never see a partial entry
             cache_file = self._get_cache_file_path(username)
-            with open(cache_file, 'w') as f:
-                json.dump(cache_data, f)
-            
-            # Set secure permissions (owner read/write only)
-            os.chmod(cache_file, 0o600)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+            try:
+                fd = os.open(tmp_file, flags, 0o600)
+            except FileExistsError:
+                # Leftover from a crashed process with the same PID; its
+                # mode can't be trusted, so replace it with a fresh file
+                os.remove(tmp_file)
+                fd = os.open(tmp_file, flags, 0o600)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(json.dumps(cache_data, separators=(',', ':')))
+                os.replace(tmp_file, cache_file)
+            except Exception:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+                raise
             
             syslog.syslog(syslog.LOG_DEBUG,
                 f"pam_nextcloud: Cached credentials for user: {username}")
@@ -221,12 +249,12 @@ class NextcloudAuth:
         try:
             cache_file = self._get_cache_file_path(username)
             
-            if not os.path.exists(cache_file):
-                return False
-            
             # Read cache file
-            with open(cache_file, 'r') as f:
-                cache_data = json.load(f)
+            try:
+                with open(cache_file, 'r') as f:
+                    cache_data = json.load(f)
+            except FileNotFoundError:
+                return False
             
             # Check if cache has expired
             if self._is_cache_expired(cache_data['timestamp']):
@@ -293,7 +321,7 @@ class NextcloudAuth:
             syslog.syslog(syslog.LOG_INFO,
                 f"pam_nextcloud: Attempting authentication for user: {username} against {api_url}")
             
-            response = requests.get(
+            response = self.session.get(
                 api_url,
                 auth=(username, password),
                 headers={
@@ -332,14 +360,15 @@ class NextcloudAuth:
                 # Invalidate cache if password failed on server (password may have changed)
                 if self.enable_cache:
                     cache_file = self._get_cache_file_path(username)
-                    if os.path.exists(cache_file):
-                        try:
-                            os.remove(cache_file)
-                            syslog.syslog(syslog.LOG_INFO,
-                                f"pam_nextcloud: Invalidated cache for user: {username} after authentication failure")
-                        except Exception as e:
-                            syslog.syslog(syslog.LOG_WARNING,
-                                f"pam_nextcloud: Could not remove cache file: {str(e)}")
+                    try:
+                        os.remove(cache_file)
+                        syslog.syslog(syslog.LOG_INFO,
+                            f"pam_nextcloud: Invalidated cache for user: {username} after authentication failure")
+                    except FileNotFoundError:
+                        pass
+                    except Exception as e:
+                        syslog.syslog(syslog.LOG_WARNING,
+                            f"pam_nextcloud: Could not remove cache file: {str(e)}")
                 # Don't try cache - password is wrong on server
                 return False
             else:
@@ -419,7 +448,7 @@ class NextcloudAuth:
             
             # Send PUT request to update user password
             # User authenticates with old password to change to new password
-            response = requests.put(
+            response = self.session.put(
                 user_url,
                 auth=(username, old_password),
                 headers={
@@ -439,7 +468,6 @@ class NextcloudAuth:
             if response.status_code == 200:
                 # Parse XML response to check actual status
                 try:
-                    import xml.etree.ElementTree as ET
                     root = ET.fromstring(response.content)
                     
                     # Find status in meta section
@@ -551,7 +579,7 @@ class NextcloudAuth:
             # Use Nextcloud OCS API to get user's groups
             api_url = urljoin(self.nextcloud_url, f'/ocs/v1.php/cloud/users/{username}/groups')
             
-            response = requests.get(
+            response = self.session.get(
                 api_url,
                 auth=(username, password),
                 headers={'OCS-APIRequest': 'true'},
@@ -572,7 +600,6 @@ class NextcloudAuth:
                         return groups
                 except (ValueError, KeyError):
                     # Try XML format
-                    import xml.etree.ElementTree as ET
                     try:
                         root = ET.fromstring(response.content)
                         groups = []
@@ -601,8 +628,100 @@ class NextcloudAuth:
             return None
 
 
-# Global authenticator instance
-_authenticator = None
+def _open_owned_directory(path, uid, gid, mode, dir_fd=None, follow_symlinks=False):
+    """
+    Open a directory and fix its ownership and mode through the descriptor
+    
+    Working on the open descriptor avoids repeated path lookups and, with
+    follow_symlinks=False, never touches the target of a symlink a user
+    may have planted in their home directory.
+    
+    Args:
+        path: Directory path (relative to dir_fd if given)
+        uid: Expected owner user ID
+        gid: Expected owner group ID
+        mode: Expected permission bits
+        dir_fd: Parent directory descriptor for relative paths
+        follow_symlinks: Whether a symlink at path may be followed
+        
+    Returns:
+        int: Open directory descriptor (caller must close), or None if
+             path is missing, not a directory, or a refused symlink
+    """
+    flags = os.O_RDONLY | os.O_DIRECTORY
+    if not follow_symlinks:
+        flags |= os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags, dir_fd=dir_fd)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            return None
+        raise
+    
+    try:
+        st = os.fstat(fd)
+        if st.st_uid != uid or st.st_gid != gid:
+            os.fchown(fd, uid, gid)
+        if st.st_mode & 0o7777 != mode:
+            os.fchmod(fd, mode)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+# Recognised PAM module arguments (key=value) and their defaults
+_MODULE_ARGS = {
+    'config': '/etc/security/pam_nextcloud.conf',
+}
+
+
+def _parse_argv(argv):
+    """
+    Parse PAM module arguments of the form key=value
+    
+    Unknown keys are ignored; missing keys take their _MODULE_ARGS default.
+    
+    Args:
+        argv: Module arguments
+        
+    Returns:
+        dict: Argument values keyed by name
+    """
+    options = dict(_MODULE_ARGS)
+    for arg in argv:
+        key, sep, value = arg.partition('=')
+        if sep and key in options:
+            options[key] = value
+    return options
+
+
+# Authenticator instances keyed by config path, shared by all PAM hooks
+_authenticators = {}
+
+
+def _get_authenticator(config_path):
+    """
+    Return the cached authenticator for a config path, creating it on first use
+    
+    Args:
+        config_path: Path to configuration file
+        
+    Returns:
+        NextcloudAuth: Authenticator for config_path
+    """
+    authenticator = _authenticators.get(config_path)
+    if authenticator is None:
+        authenticator = _authenticators[config_path] = NextcloudAuth(config_path)
+    return authenticator
+
+
+# Old passwords handed from PAM_PRELIM_CHECK to PAM_UPDATE_AUTHTOK, keyed by
+# username. Both phases run in the same process, so no filesystem round-trip
+# is needed when pamh.oldauthtok cannot be assigned.
+_pending_old_passwords = {}
 
 
 def pam_sm_authenticate(pamh, flags, argv):
@@ -619,8 +738,6 @@ def pam_sm_authenticate(pamh, flags, argv):
     Returns:
         int: PAM_SUCCESS on success, PAM_AUTH_ERR on failure
     """
-    global _authenticator
-    
     try:
         # Initialize syslog
         syslog.openlog("pam_nextcloud", syslog.LOG_PID, syslog.LOG_AUTH)
@@ -655,17 +772,13 @@ def pam_sm_authenticate(pamh, flags, argv):
             return pamh.PAM_AUTH_ERR
         
         # Parse module arguments for custom config path
-        config_path = '/etc/security/pam_nextcloud.conf'
-        for arg in argv:
-            if arg.startswith('config='):
-                config_path = arg.split('=', 1)[1]
+        config_path = _parse_argv(argv)['config']
         
         # Initialize authenticator
-        if _authenticator is None or _authenticator.config_path != config_path:
-            _authenticator = NextcloudAuth(config_path)
+        authenticator = _get_authenticator(config_path)
         
         # Authenticate
-        if _authenticator.authenticate(username, password):
+        if authenticator.authenticate(username, password):
             return pamh.PAM_SUCCESS
         else:
             return pamh.PAM_AUTH_ERR
@@ -751,25 +864,31 @@ def pam_sm_open_session(pamh, flags, argv):
             gid = user_info.pw_gid
             
             # Ensure home directory has correct ownership and permissions
-            if os.path.exists(home_dir):
-                os.chown(home_dir, uid, gid)
-                os.chmod(home_dir, 0o755)
-                
-                # Fix permissions on standard directories if they exist
-                # (they should have been created from /etc/skel)
-                standard_dirs = [
-                    '.config',
-                    '.cache',
-                    '.local',
-                    '.local/share',
-                    '.local/state'
-                ]
-                
-                for dir_name in standard_dirs:
-                    dir_path = os.path.join(home_dir, dir_name)
-                    if os.path.exists(dir_path):
-                        os.chown(dir_path, uid, gid)
-                        os.chmod(dir_path, 0o755)
+            # (a single fstat per directory on the common already-correct login)
+            home_fd = _open_owned_directory(home_dir, uid, gid, 0o755, follow_symlinks=True)
+            if home_fd is not None:
+                try:
+                    # Fix permissions on standard directories if they exist
+                    # (they should have been created from /etc/skel)
+                    standard_dirs = {
+                        '.config': (),
+                        '.cache': (),
+                        '.local': ('share', 'state'),
+                    }
+                    
+                    for dir_name, subdirs in standard_dirs.items():
+                        dir_fd = _open_owned_directory(dir_name, uid, gid, 0o755, dir_fd=home_fd)
+                        if dir_fd is None:
+                            continue
+                        try:
+                            for subdir in subdirs:
+                                sub_fd = _open_owned_directory(subdir, uid, gid, 0o755, dir_fd=dir_fd)
+                                if sub_fd is not None:
+                                    os.close(sub_fd)
+                        finally:
+                            os.close(dir_fd)
+                finally:
+                    os.close(home_fd)
         except Exception as e:
             syslog.syslog(syslog.LOG_WARNING,
                 f"pam_nextcloud: Could not fix home directory permissions: {str(e)}")
@@ -818,8 +937,6 @@ def pam_sm_chauthtok(pamh, flags, argv):
     Returns:
         int: PAM_SUCCESS on success, error code on failure
     """
-    global _authenticator
-    
     try:
         # Initialize syslog
         syslog.openlog("pam_nextcloud", syslog.LOG_PID, syslog.LOG_AUTH)
@@ -838,14 +955,10 @@ def pam_sm_chauthtok(pamh, flags, argv):
             return pamh.PAM_USER_UNKNOWN
         
         # Parse module arguments for custom config path
-        config_path = '/etc/security/pam_nextcloud.conf'
-        for arg in argv:
-            if arg.startswith('config='):
-                config_path = arg.split('=', 1)[1]
+        config_path = _parse_argv(argv)['config']
         
         # Initialize authenticator
-        if _authenticator is None or _authenticator.config_path != config_path:
-            _authenticator = NextcloudAuth(config_path)
+        authenticator = _get_authenticator(config_path)
         
         # PAM_PRELIM_CHECK: Verify old password
         if flags & pamh.PAM_PRELIM_CHECK:
@@ -867,7 +980,7 @@ def pam_sm_chauthtok(pamh, flags, argv):
                     return pamh.PAM_AUTHTOK_ERR
                 
                 # Verify old password
-                if _authenticator.authenticate(username, old_password):
+                if authenticator.authenticate(username, old_password):
                     # Store old password for UPDATE phase
                     # Try to set oldauthtok directly (if supported by PAM)
                     try:
@@ -875,22 +988,10 @@ def pam_sm_chauthtok(pamh, flags, argv):
                         syslog.syslog(syslog.LOG_INFO,
                             f"pam_nextcloud: Stored old password in oldauthtok for user: {username}")
                     except AttributeError:
-                        # Fallback: store in a temporary file if direct assignment not supported
-                        try:
-                            import pwd
-                            import os
-                            user_info = pwd.getpwnam(username)
-                            run_dir = f"/run/pam-nextcloud/{user_info.pw_uid}"
-                            os.makedirs(run_dir, mode=0o700, exist_ok=True)
-                            old_pass_file = os.path.join(run_dir, 'old_password')
-                            with open(old_pass_file, 'w') as f:
-                                f.write(old_password)
-                            os.chmod(old_pass_file, 0o600)
-                            syslog.syslog(syslog.LOG_INFO,
-                                f"pam_nextcloud: Stored old password in file for user: {username}")
-                        except Exception as e:
-                            syslog.syslog(syslog.LOG_WARNING,
-                                f"pam_nextcloud: Could not store old password: {str(e)}")
+                        # Fallback: keep it in process memory for the UPDATE phase
+                        _pending_old_passwords[username] = old_password
+                        syslog.syslog(syslog.LOG_INFO,
+                            f"pam_nextcloud: Stored old password in memory for user: {username}")
                     
                     return pamh.PAM_SUCCESS
                 else:
@@ -920,24 +1021,30 @@ def pam_sm_chauthtok(pamh, flags, argv):
                 except AttributeError:
                     pass
                 
-                # If not available, try to read from temporary storage
+                # Next, the in-memory handoff from the PRELIM phase
+                if old_password is None:
+                    old_password = _pending_old_passwords.pop(username, None)
+                    if old_password:
+                        syslog.syslog(syslog.LOG_INFO,
+                            f"pam_nextcloud: Retrieved old password from memory for user: {username}")
+                
+                # Legacy fallback: temporary file written by older module versions
                 if old_password is None:
                     try:
-                        import pwd
-                        import os
                         user_info = pwd.getpwnam(username)
                         run_dir = f"/run/pam-nextcloud/{user_info.pw_uid}"
                         old_pass_file = os.path.join(run_dir, 'old_password')
-                        if os.path.exists(old_pass_file):
-                            with open(old_pass_file, 'r') as f:
-                                old_password = f.read().strip()
-                            # Remove file after reading for security
-                            try:
-                                os.remove(old_pass_file)
-                            except Exception:
-                                pass
-                            syslog.syslog(syslog.LOG_INFO,
-                                f"pam_nextcloud: Retrieved old password from file for user: {username}")
+                        with open(old_pass_file, 'r') as f:
+                            old_password = f.read().strip()
+                        # Remove file after reading for security
+                        try:
+                            os.remove(old_pass_file)
+                        except Exception:
+                            pass
+                        syslog.syslog(syslog.LOG_INFO,
+                            f"pam_nextcloud: Retrieved old password from file for user: {username}")
+                    except FileNotFoundError:
+                        pass
                     except Exception as e:
                         syslog.syslog(syslog.LOG_DEBUG,
                             f"pam_nextcloud: Could not read stored old password: {str(e)}")
@@ -975,7 +1082,7 @@ def pam_sm_chauthtok(pamh, flags, argv):
                     f"pam_nextcloud: Calling change_password API for user: {username}")
                 
                 # Change password on Nextcloud
-                if _authenticator.change_password(username, old_password, new_password):
+                if authenticator.change_password(username, old_password, new_password):
                     syslog.syslog(syslog.LOG_INFO,
                         f"pam_nextcloud: Password changed successfully for user: {username}")
                     return pamh.PAM_SUCCESS
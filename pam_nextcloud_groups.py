@@ -14,50 +14,147 @@ Features:
 
 import os
 import sys
-import subprocess
 import syslog
 import grp
-import configparser
+import functools
 from typing import List, Dict, Optional
 
 
+# Open the syslog connection once rather than implicitly on first message
+syslog.openlog('pam_nextcloud_groups', syslog.LOG_PID, syslog.LOG_AUTH)
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_config(config_path: str, mtime_ns: int) -> Dict[str, Dict[str, str]]:
+    """
+    Parse the configuration file into a plain dict of sections
+    
+    Cached on (path, mtime) so repeated loads skip the parse until the file
+    changes. Callers must treat the result as read-only.
+    """
+    # Imported here so importing this module never pays for it
+    import configparser
+    config = configparser.ConfigParser()
+    with open(config_path, 'r') as f:
+        config.read_file(f)
+    return {section: dict(config.items(section)) for section in config.sections()}
+
+
+def _read_config(config_path: str) -> Optional[Dict[str, Dict[str, str]]]:
+    """
+    Return the parsed configuration, or None if the file does not exist
+    """
+    try:
+        mtime_ns = os.stat(config_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _parse_config(config_path, mtime_ns)
+
+
+def _getboolean(section: Dict[str, str], option: str, fallback: bool) -> bool:
+    """
+    Read a boolean option from a parsed config section
+    
+    Accepts the same values as ConfigParser.getboolean().
+    
+    Raises:
+        ValueError: If the value is not a recognised boolean
+    """
+    value = section.get(option)
+    if value is None:
+        return fallback
+    import configparser
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError(f"Not a boolean: {value}")
+
+
+class _GroupNameTable(dict):
+    """
+    str.translate() table mapping characters invalid in group names to '_'
+    
+    Entries are computed on first sight of each code point and cached, so
+    non-ASCII letters keep the same isalnum() treatment as before.
+    """
+    
+    def __missing__(self, codepoint: int):
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in '-_' else '_'
+        self[codepoint] = value
+        return value
+
+
+_GROUP_NAME_TABLE = _GroupNameTable()
+
+
+@functools.lru_cache(maxsize=512)
+def _normalize_group_name(nextcloud_group: str, prefix: str) -> str:
+    """
+    Convert a Nextcloud group name to a Linux-compatible group name
+    
+    Args:
+        nextcloud_group: Nextcloud group name
+        prefix: Prefix for managed groups ('' for none)
+        
+    Returns:
+        str: Normalized group name
+    """
+    # Remove special characters, convert to lowercase
+    normalized = nextcloud_group.translate(_GROUP_NAME_TABLE)
+    normalized = normalized.lower().strip('_')
+    
+    # Add prefix only if configured (empty by default)
+    if prefix and not normalized.startswith(prefix):
+        normalized = prefix + normalized
+    
+    return normalized
+
+
 class GroupSync:
     """Handles group synchronization from Nextcloud to Linux"""
     
-    def __init__(self, config_path='/etc/security/pam_nextcloud.conf'):
+    def __init__(self, config_path='/etc/security/pam_nextcloud.conf',
+                 config: Optional[Dict[str, Dict[str, str]]] = None):
         """
         Initialize group synchronization
         
         Args:
             config_path: Path to configuration file
+            config: Already-parsed configuration (skips reading config_path)
         """
         self.config_path = config_path
         self.group_mapping = {}
         self.managed_groups_prefix = ''  # No prefix by default
         self.enable_sudo_mapping = False  # Disabled by default
         self.create_missing_groups = True
-        self.load_config()
+        self._mapped_groups = {}
+        self.load_config(config)
     
-    def load_config(self):
-        """Load group synchronization configuration"""
+    def load_config(self, config: Optional[Dict[str, Dict[str, str]]] = None):
+        """
+        Load group synchronization configuration
+        
+        Args:
+            config: Already-parsed configuration; read from config_path if None
+        """
         try:
-            if not os.path.exists(self.config_path):
+            if config is None:
+                config = _read_config(self.config_path)
+            if config is None:
                 return
             
-            config = configparser.ConfigParser()
-            config.read(self.config_path)
-            
             # Load group mapping
-            if config.has_section('group_mapping'):
-                for nextcloud_group, linux_groups in config.items('group_mapping'):
-                    # Support multiple Linux groups separated by comma
-                    self.group_mapping[nextcloud_group] = [g.strip() for g in linux_groups.split(',')]
+            for nextcloud_group, linux_groups in config.get('group_mapping', {}).items():
+                # Support multiple Linux groups separated by comma
+                self.group_mapping[nextcloud_group] = [g.strip() for g in linux_groups.split(',')]
             
             # Load other settings
-            if config.has_section('group_sync'):
-                self.managed_groups_prefix = config.get('group_sync', 'prefix', fallback='')  # Empty by default
-                self.enable_sudo_mapping = config.getboolean('group_sync', 'enable_sudo_mapping', fallback=False)  # Disabled by default
-                self.create_missing_groups = config.getboolean('group_sync', 'create_missing_groups', fallback=True)
+            if 'group_sync' in config:
+                group_sync = config['group_sync']
+                self.managed_groups_prefix = group_sync.get('prefix', '')  # Empty by default
+                self.enable_sudo_mapping = _getboolean(group_sync, 'enable_sudo_mapping', False)  # Disabled by default
+                self.create_missing_groups = _getboolean(group_sync, 'create_missing_groups', True)
             
         except Exception as e:
             syslog.syslog(syslog.LOG_ERR,
@@ -81,6 +178,8 @@ class GroupSync:
         Returns:
             bool: True if successful, False otherwise
         """
+        import subprocess
+        
         try:
             # Use groupadd command
             result = subprocess.run(
@@ -127,6 +226,8 @@ class GroupSync:
         Returns:
             bool: True if successful, False otherwise
         """
+        import subprocess
+        
         try:
             # Use usermod or gpasswd
             # gpasswd is more reliable for adding to groups
@@ -155,6 +256,45 @@ class GroupSync:
                 f"pam_nextcloud_groups: Error adding user to group {groupname}: {str(e)}")
             return False
     
+    def _add_user_to_groups(self, username: str, groupnames: List[str]) -> bool:
+        """
+        Add user to several groups with a single usermod call
+        
+        Args:
+            username: Username to add
+            groupnames: Group names
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        import subprocess
+        
+        try:
+            result = subprocess.run(
+                ['usermod', '-a', '-G', ','.join(groupnames), username],
+                capture_output=True,
+                text=True,
+                timeout=10
+            )
+            
+            if result.returncode == 0:
+                syslog.syslog(syslog.LOG_INFO,
+                    f"pam_nextcloud_groups: Added user {username} to groups: {', '.join(groupnames)}")
+                return True
+            else:
+                syslog.syslog(syslog.LOG_WARNING,
+                    f"pam_nextcloud_groups: Failed to add user {username} to groups {', '.join(groupnames)}: {result.stderr}")
+                return False
+                
+        except subprocess.TimeoutExpired:
+            syslog.syslog(syslog.LOG_ERR,
+                f"pam_nextcloud_groups: Timeout adding user to groups: {', '.join(groupnames)}")
+            return False
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ERR,
+                f"pam_nextcloud_groups: Error adding user to groups {', '.join(groupnames)}: {str(e)}")
+            return False
+    
     def _normalize_group_name(self, nextcloud_group: str) -> str:
         """
         Normalize Nextcloud group name for Linux
@@ -167,26 +307,27 @@ class GroupSync:
         Returns:
             str: Normalized group name
         """
-        # Remove special characters, convert to lowercase
-        normalized = ''.join(c if c.isalnum() or c in '-_' else '_' for c in nextcloud_group)
-        normalized = normalized.lower().strip('_')
-        
-        # Add prefix only if configured (empty by default)
-        if self.managed_groups_prefix and not normalized.startswith(self.managed_groups_prefix):
-            normalized = self.managed_groups_prefix + normalized
-        
-        return normalized
+        return _normalize_group_name(nextcloud_group, self.managed_groups_prefix)
     
     def _get_mapped_groups(self, nextcloud_group: str) -> List[str]:
         """
         Get mapped Linux groups for a Nextcloud group
         
+        Results are memoized per instance; callers must not modify the list.
+        
         Args:
             nextcloud_group: Nextcloud group name
             
         Returns:
             list: List of Linux group names to use
         """
+        mapped = self._mapped_groups.get(nextcloud_group)
+        if mapped is None:
+            mapped = self._mapped_groups[nextcloud_group] = self._resolve_mapped_groups(nextcloud_group)
+        return mapped
+    
+    def _resolve_mapped_groups(self, nextcloud_group: str) -> List[str]:
+        """Compute the mapped Linux groups for a Nextcloud group (uncached)"""
         # Check explicit mapping first
         if nextcloud_group in self.group_mapping:
             return self.group_mapping[nextcloud_group]
@@ -224,37 +365,70 @@ class GroupSync:
         
         success = True
         synced_groups = []
+        groups_to_join = []
+        already_member = []
+        missing_groups = []
+        
+        # One enumeration of the group database instead of a getgrnam()
+        # per check (each may be a network round-trip with SSSD/LDAP);
+        # only groups missing from it are looked up individually
+        group_members = {group.gr_name: group.gr_mem for group in grp.getgrall()}
         
         for nc_group in nextcloud_groups:
             # Get mapped Linux groups
             linux_groups = self._get_mapped_groups(nc_group)
             
             for linux_group in linux_groups:
+                # getgrall() omits directory groups when enumeration is
+                # off (the SSSD default), so confirm a miss with getgrnam()
+                if linux_group not in group_members:
+                    try:
+                        group_members[linux_group] = grp.getgrnam(linux_group).gr_mem
+                    except KeyError:
+                        pass
+                
                 # Skip if already a member
-                if self._user_in_group(username, linux_group):
-                    syslog.syslog(syslog.LOG_DEBUG,
-                        f"pam_nextcloud_groups: User {username} already in group: {linux_group}")
+                if username in group_members.get(linux_group, ()):
+                    already_member.append(linux_group)
                     synced_groups.append(linux_group)
                     continue
                 
                 # Create group if it doesn't exist
-                if not self._group_exists(linux_group):
+                if linux_group not in group_members:
                     if self.create_missing_groups:
                         if not self._create_group(linux_group):
                             syslog.syslog(syslog.LOG_ERR,
                                 f"pam_nextcloud_groups: Failed to create group: {linux_group}")
                             success = False
                             continue
+                        group_members[linux_group] = []
                     else:
-                        syslog.syslog(syslog.LOG_WARNING,
-                            f"pam_nextcloud_groups: Group {linux_group} doesn't exist and auto-creation is disabled")
+                        missing_groups.append(linux_group)
                         continue
                 
-                # Add user to group
-                if self._add_user_to_group(username, linux_group):
-                    synced_groups.append(linux_group)
-                else:
-                    success = False
+                # Add user to group (batched below)
+                if linux_group not in groups_to_join:
+                    groups_to_join.append(linux_group)
+        
+        # One log line per category rather than one per group
+        if already_member:
+            syslog.syslog(syslog.LOG_DEBUG,
+                f"pam_nextcloud_groups: User {username} already in groups: {', '.join(already_member)}")
+        if missing_groups:
+            syslog.syslog(syslog.LOG_WARNING,
+                f"pam_nextcloud_groups: Groups don't exist and auto-creation is disabled: {', '.join(missing_groups)}")
+        
+        # Join all missing groups in one usermod call; if that fails (e.g.
+        # one bad group name), fall back to adding them one at a time
+        if groups_to_join:
+            if self._add_user_to_groups(username, groups_to_join):
+                synced_groups.extend(groups_to_join)
+            else:
+                for linux_group in groups_to_join:
+                    if self._add_user_to_group(username, linux_group):
+                        synced_groups.append(linux_group)
+                    else:
+                        success = False
         
         if synced_groups:
             syslog.syslog(syslog.LOG_INFO,
@@ -270,10 +444,9 @@ def main():
     config_path = '/etc/security/pam_nextcloud.conf'
     
     # Check if group sync is enabled
-    config = configparser.ConfigParser()
-    config.read(config_path)
+    config = _read_config(config_path) or {}
     
-    if not config.getboolean('nextcloud', 'enable_group_sync', fallback=False):
+    if not _getboolean(config.get('nextcloud', {}), 'enable_group_sync', False):
         print("Group synchronization is disabled in configuration")
         return 0
     
@@ -295,7 +468,7 @@ def main():
     nextcloud_groups = [g.strip() for g in groups_str.split(',') if g.strip()]
     
     # Sync groups
-    group_sync = GroupSync(config_path)
+    group_sync = GroupSync(config_path, config=config)
     
     if group_sync.sync_groups(username, nextcloud_groups):
         print(f"Group synchronization completed for {username}")
@@ -10,15 +10,140 @@
 #   python3 test_nextcloud_passwd.py --username USERNAME --old-password OLD --new-password NEW
 #   python3 test_nextcloud_passwd.py --url https://nextcloud.example.com
 
+# requests, argparse, getpass and configparser are imported where they are
+# first needed, so --help and library use of load_config stay cheap.
 import sys
-import getpass
-import argparse
-import requests
-from urllib.parse import urljoin
-import configparser
+import time
+import base64
+import functools
+import xml.etree.ElementTree as ET
 
+# Shared session so the verify and update requests reuse one keep-alive
+# connection (created on first use, see _get_session)
+_SESSION = None
+
+def _get_session():
+    """Return the shared HTTP session, creating it on first use"""
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        
+        # Retry transient failures with exponential backoff. Connection errors are
+        # retried for any method (the request never reached the server), but read
+        # errors and 5xx/429 responses only for the GET: the password PUT must not
+        # be replayed after the server may already have applied it.
+        retry = Retry(
+            total=3,
+            backoff_factor=1.0,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+        _SESSION = requests.Session()
+        _SESSION.mount('https://', adapter)
+        _SESSION.mount('http://', adapter)
+        _SESSION.headers.update({'OCS-APIRequest': 'true'})
+    return _SESSION
+
+def _basic_auth(username, password):
+    """
+    Build the Basic credentials once for every request (and retry) of a test
+    
+    They are encoded as Latin-1, exactly like requests' auth=(user, password)
+    used by pam_nextcloud, so the test sees what the PAM module sends. Being
+    passed as auth= also keeps requests from substituting ~/.netrc credentials.
+    """
+    credentials = b':'.join((username.encode('latin1'), password.encode('latin1')))
+    header = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+    
+    def auth(r):
+        r.headers['Authorization'] = header
+        return r
+    
+    return auth
+
+# Largest OCS reply read while looking for the <meta> section
+OCS_META_MAX_BYTES = 64 * 1024
+
+def _read_ocs_meta(response, body, max_bytes=OCS_META_MAX_BYTES):
+    """
+    Stream an OCS XML reply just far enough to read its <meta> section
+    
+    Reading stops as soon as </meta> has been parsed, so an unexpectedly
+    large body (e.g. an HTML error page) is never fully downloaded or
+    built into a tree.
+    
+    Args:
+        response: Streamed requests.Response (stream=True)
+        body: bytearray that receives the bytes read, for error previews
+        max_bytes: Give up after reading this many bytes
+        
+    Returns:
+        Element: The root's <meta> child, or None if the document has none
+        
+    Raises:
+        ET.ParseError: If the body is not well-formed XML or is too large
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    depth = 0
+    try:
+        for chunk in response.iter_content(chunk_size=8192):
+            body += chunk
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    depth += 1
+                    continue
+                # Only <ocs><meta>, like root.find('meta'); not e.g. an
+                # HTML <head><meta> or a <meta> nested inside <data>
+                if depth == 2 and element.tag == 'meta':
+                    return element
+                depth -= 1
+            if len(body) > max_bytes:
+                raise ET.ParseError(f"no OCS meta section in the first {max_bytes} bytes")
+        parser.close()
+        return None
+    finally:
+        response.close()
+
+# Output lines of the running test, written out in batches by _flush_output
+_out = []
+
+def _flush_output():
+    """Write buffered output lines to stdout in a single call"""
+    if _out:
+        sys.stdout.write('\n'.join(_out) + '\n')
+        _out.clear()
+    sys.stdout.flush()
+
+def _preview(response, limit=500):
+    """
+    Return the start of a response body for display
+    
+    At most limit bytes are read (a streamed body is not downloaded any
+    further) and decoded as UTF-8 without charset detection.
+    """
+    try:
+        head = next(response.iter_content(chunk_size=limit), b'')
+    except Exception:
+        head = b''
+    finally:
+        response.close()
+    return head[:limit].decode('utf-8', errors='replace')
+
+@functools.lru_cache(maxsize=4)
 def load_config(config_path='/etc/security/pam_nextcloud.conf'):
-    """Load configuration from PAM config file"""
+    """Load configuration from PAM config file
+    
+    The parsed config is cached per path and shared between callers,
+    so it must be treated as read-only.
+    """
+    import configparser
+    
     config = configparser.ConfigParser()
     try:
         with open(config_path, 'r') as f:
@@ -36,7 +161,9 @@ def load_config(config_path='/etc/security/pam_nextcloud.conf'):
     
     return config
 
-def change_password_api(nextcloud_url, username, old_password, new_password, verify_ssl=True, timeout=10):
+def change_password_api(nextcloud_url, username, old_password, new_password, verify_ssl=True, timeout=10,
+                        connect_timeout=5, overall_timeout=60, verify_first=False,
+                        debug=False):
     """
     Test password change using Nextcloud OCS API
     
@@ -45,6 +172,14 @@ def change_password_api(nextcloud_url, username, old_password, new_password, ver
         username: Username whose password to change
         old_password: Current password (for authentication)
         new_password: New password to set
+        verify_ssl: Verify the server's TLS certificate
+        timeout: Read timeout per request attempt, in seconds
+        connect_timeout: Connect timeout per request attempt, in seconds
+        overall_timeout: Seconds after which the password change is no longer sent;
+            the change request's timeouts are capped at the time left
+        verify_first: Check the old password with a separate GET before the PUT
+            (the PUT's own 401 already reports a wrong old password)
+        debug: Also print all response headers
         
     Returns:
         tuple: (success: bool, message: str, response: requests.Response or None)
@@ -52,118 +187,130 @@ def change_password_api(nextcloud_url, username, old_password, new_password, ver
     if not nextcloud_url or not username or not old_password or not new_password:
         return False, "Missing required parameters", None
     
+    import requests
+    from urllib.parse import urljoin, quote
+    
+    session = _get_session()
+    # Both requests target the same OCS user resource; the username is
+    # percent-encoded so names containing '@', '+' or '/' stay one path segment
+    user_url = f"{urljoin(nextcloud_url, '/ocs/v1.php/cloud/users')}/{quote(username, safe='')}"
+    request_timeout = (min(connect_timeout, timeout), timeout)
+    deadline = time.monotonic() + overall_timeout
+    
     try:
-        # First verify the old password
-        print(f"\n🔍 Step 1: Verifying old password...")
-        auth_url = urljoin(nextcloud_url, '/ocs/v1.php/cloud/users')
-        check_url = urljoin(auth_url + '/', username)
+        auth = _basic_auth(username, old_password)
         
-        check_response = requests.get(
-            check_url,
-            auth=(username, old_password),
-            headers={'OCS-APIRequest': 'true'},
-            verify=verify_ssl,
-            timeout=timeout
-        )
+        if verify_first:
+            # First verify the old password
+            _out.append(f"\n🔍 Step 1: Verifying old password...")
+            _flush_output()
+            # Streamed so an unexpected reply is only previewed, not downloaded;
+            # the small OCS body is drained otherwise so the connection goes
+            # back to the pool for the PUT (close() would drop it)
+            check_response = session.get(
+                user_url,
+                auth=auth,
+                verify=verify_ssl,
+                timeout=request_timeout,
+                stream=True
+            )
+            
+            _out.append(f"   Status code: {check_response.status_code}")
+            if check_response.status_code == 200:
+                check_response.content
+                _out.append("   ✅ Old password verified successfully")
+            elif check_response.status_code == 401:
+                check_response.content
+                return False, "Old password verification failed (401 Unauthorized)", check_response
+            else:
+                _out.append(f"   ⚠️  Warning: Unexpected status {check_response.status_code}")
+                _out.append(f"   Response: {_preview(check_response, 200)}")
         
-        print(f"   Status code: {check_response.status_code}")
-        if check_response.status_code == 200:
-            print("   ✅ Old password verified successfully")
-        elif check_response.status_code == 401:
-            return False, "Old password verification failed (401 Unauthorized)", check_response
-        else:
-            print(f"   ⚠️  Warning: Unexpected status {check_response.status_code}")
-            print(f"   Response: {check_response.text[:200]}")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False, f"Overall deadline of {overall_timeout}s exceeded before changing password", None
         
         # Now change the password
-        print(f"\n🔧 Step 2: Changing password...")
-        api_url = urljoin(nextcloud_url, '/ocs/v1.php/cloud/users')
-        user_url = urljoin(api_url + '/', username)
-        
-        print(f"   URL: {user_url}")
-        print(f"   Method: PUT")
-        print(f"   Auth: {username} / {'*' * len(old_password)}")
-        print(f"   Data: key=password, value={'*' * len(new_password)}")
+        _out.append(f"\n🔧 Step {2 if verify_first else 1}: Changing password...")
+        _out.append(f"   URL: {user_url}")
+        _out.append(f"   Method: PUT")
+        _out.append(f"   Auth: {username} / {'*' * len(old_password)}")
+        _out.append(f"   Data: key=password, value={'*' * len(new_password)}")
         
         # Send PUT request to update user password
-        response = requests.put(
+        _flush_output()
+        response = session.put(
             user_url,
-            auth=(username, old_password),
-            headers={
-                'OCS-APIRequest': 'true',
-                'Content-Type': 'application/x-www-form-urlencoded'
-            },
+            auth=auth,
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
             data={'key': 'password', 'value': new_password},
             verify=verify_ssl,
-            timeout=timeout
+            timeout=tuple(min(limit, remaining) for limit in request_timeout),
+            stream=True
         )
         
-        print(f"\n📊 Response Details:")
-        print(f"   Status Code: {response.status_code}")
-        print(f"   Headers: {dict(response.headers)}")
-        print(f"   Content-Type: {response.headers.get('Content-Type', 'unknown')}")
+        _out.append(f"\n📊 Response Details:")
+        _out.append(f"   Status Code: {response.status_code}")
+        if debug:
+            _out.append(f"   Headers: {dict(response.headers)}")
+        _out.append(f"   Content-Type: {response.headers.get('Content-Type', 'unknown')}")
         
         # Check response
         if response.status_code == 200:
             # Parse XML response to check actual OCS status
+            body = bytearray()
             try:
-                import xml.etree.ElementTree as ET
-                root = ET.fromstring(response.content)
-                
                 # Find status in meta section
-                meta = root.find('meta')
+                meta = _read_ocs_meta(response, body)
                 if meta is not None:
-                    status_elem = meta.find('status')
-                    statuscode_elem = meta.find('statuscode')
-                    message_elem = meta.find('message')
-                    
-                    status = status_elem.text if status_elem is not None else None
-                    statuscode = statuscode_elem.text if statuscode_elem is not None else None
-                    message = message_elem.text if message_elem is not None else None
+                    status = meta.findtext('status')
+                    statuscode = meta.findtext('statuscode')
+                    message = meta.findtext('message')
                     
-                    print(f"\n📋 OCS XML Response:")
-                    print(f"   Status: {status}")
-                    print(f"   Status Code: {statuscode}")
+                    _out.append(f"\n📋 OCS XML Response:")
+                    _out.append(f"   Status: {status}")
+                    _out.append(f"   Status Code: {statuscode}")
                     if message:
-                        print(f"   Message: {message}")
+                        _out.append(f"   Message: {message}")
                     
                     # Status code 100 means OK, anything else is failure
                     if status == 'ok' or statuscode == '100':
-                        print(f"\n✅ SUCCESS: Password changed successfully!")
+                        _out.append(f"\n✅ SUCCESS: Password changed successfully!")
                         return True, "Password changed successfully", response
                     else:
-                        print(f"\n❌ FAILED: Password change rejected by Nextcloud")
-                        print(f"   Reason: {message or f'Status code {statuscode}'}")
-                        return False, f"Password change failed: {message or f'Status code {statuscode}'}", response
+                        fail_reason = message or f"Status code {statuscode}"
+                        _out.append(f"\n❌ FAILED: Password change rejected by Nextcloud")
+                        _out.append(f"   Reason: {fail_reason}")
+                        return False, f"Password change failed: {fail_reason}", response
                 else:
-                    print(f"\n⚠️  WARNING: No meta section in XML response")
-                    print(f"   Assuming success (some Nextcloud versions may not return XML)")
-                    print(f"\n✅ SUCCESS: Password changed successfully!")
+                    _out.append(f"\n⚠️  WARNING: No meta section in XML response")
+                    _out.append(f"   Assuming success (some Nextcloud versions may not return XML)")
+                    _out.append(f"\n✅ SUCCESS: Password changed successfully!")
                     return True, "Password changed successfully", response
             except ET.ParseError as e:
-                print(f"\n⚠️  WARNING: Could not parse XML response: {e}")
-                print(f"   Response body: {response.text[:500]}")
-                print(f"   Assuming success since HTTP status is 200")
-                print(f"\n✅ SUCCESS: Password changed successfully!")
+                _out.append(f"\n⚠️  WARNING: Could not parse XML response: {e}")
+                _out.append(f"   Response body: {body[:500].decode('utf-8', errors='replace')}")
+                _out.append(f"   Assuming success since HTTP status is 200")
+                _out.append(f"\n✅ SUCCESS: Password changed successfully!")
                 return True, "Password changed successfully", response
             except Exception as e:
-                print(f"\n❌ ERROR: Unexpected error parsing XML: {e}")
+                _out.append(f"\n❌ ERROR: Unexpected error parsing XML: {e}")
                 return False, f"Error parsing XML response: {str(e)}", response
         elif response.status_code == 401:
-            print(f"\n❌ FAILED: Unauthorized (401)")
-            print(f"   Response: {response.text[:500]}")
+            _out.append(f"\n❌ FAILED: Unauthorized (401)")
+            _out.append(f"   Response: {_preview(response)}")
             return False, "Password change unauthorized - old password may be incorrect", response
         elif response.status_code == 403:
-            print(f"\n❌ FAILED: Forbidden (403)")
-            print(f"   Response: {response.text[:500]}")
+            _out.append(f"\n❌ FAILED: Forbidden (403)")
+            _out.append(f"   Response: {_preview(response)}")
             return False, "Password change forbidden - user may lack permission", response
         elif response.status_code == 404:
-            print(f"\n❌ FAILED: User not found (404)")
-            print(f"   Response: {response.text[:500]}")
+            _out.append(f"\n❌ FAILED: User not found (404)")
+            _out.append(f"   Response: {_preview(response)}")
             return False, "User not found on Nextcloud", response
         else:
-            print(f"\n❌ FAILED: Unexpected status code {response.status_code}")
-            print(f"   Response: {response.text[:500]}")
+            _out.append(f"\n❌ FAILED: Unexpected status code {response.status_code}")
+            _out.append(f"   Response: {_preview(response)}")
             return False, f"Unexpected response code {response.status_code}", response
             
     except requests.exceptions.Timeout:
@@ -174,8 +321,33 @@ def change_password_api(nextcloud_url, username, old_password, new_password, ver
         return False, f"Connection error: {str(e)}", None
     except Exception as e:
         return False, f"Unexpected error: {str(e)}", None
+    finally:
+        _flush_output()
+
+# Fixed blocks of report output, each written with a single call
+_RULE = "=" * 70
+_BANNER = f"""{_RULE}
+Nextcloud Password Change API Test
+{_RULE}
+"""
+_TROUBLESHOOTING = """
+💡 Troubleshooting:
+   • Check if the user has permission to change their own password
+   • Verify the Nextcloud server supports password changes via OCS API
+   • Check Nextcloud server logs for more details
+   • Ensure the user account is not disabled"""
 
-def main():
+# Command-line parser, built on first use (see _get_parser)
+_PARSER = None
+
+def _get_parser():
+    """Return the command-line parser, building it only once per process"""
+    global _PARSER
+    if _PARSER is not None:
+        return _PARSER
+    
+    import argparse
+    
     parser = argparse.ArgumentParser(
         description='Test Nextcloud password change API',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -202,12 +374,23 @@ Examples:
                        help='Disable SSL certificate verification')
     parser.add_argument('--timeout', type=int, default=10,
                        help='Request timeout in seconds (default: 10)')
+    parser.add_argument('--overall-timeout', type=int, default=60,
+                       help='Do not send the password change once this many seconds have passed, '
+                            'and cap its connect/read timeouts at the time left (default: 60)')
+    parser.add_argument('--verify-first', action='store_true',
+                       help='Verify the old password with a separate request before changing it')
+    parser.add_argument('--debug', action='store_true',
+                       help='Show full response headers')
+    
+    _PARSER = parser
+    return parser
+
+def main(argv=None):
+    import getpass
     
-    args = parser.parse_args()
+    args = _get_parser().parse_args(argv)
     
-    print("=" * 70)
-    print("Nextcloud Password Change API Test")
-    print("=" * 70)
+    sys.stdout.write(_BANNER)
     
     # Load configuration
     config = load_config(args.config)
@@ -286,23 +469,19 @@ Examples:
     # Test password change
     success, message, response = change_password_api(
         nextcloud_url, username, old_password, new_password,
-        verify_ssl=verify_ssl, timeout=timeout
+        verify_ssl=verify_ssl, timeout=timeout, overall_timeout=args.overall_timeout,
+        verify_first=args.verify_first, debug=args.debug
     )
     
-    print("\n" + "=" * 70)
+    summary = [f"\n{_RULE}"]
     if success:
-        print("✅ TEST PASSED")
-        print(f"   {message}")
+        summary.append(f"✅ TEST PASSED\n   {message}")
     else:
-        print("❌ TEST FAILED")
-        print(f"   {message}")
+        summary.append(f"❌ TEST FAILED\n   {message}")
         if response is not None:
-            print(f"\n💡 Troubleshooting:")
-            print(f"   • Check if the user has permission to change their own password")
-            print(f"   • Verify the Nextcloud server supports password changes via OCS API")
-            print(f"   • Check Nextcloud server logs for more details")
-            print(f"   • Ensure the user account is not disabled")
-    print("=" * 70)
+            summary.append(_TROUBLESHOOTING)
+    summary.append(_RULE)
+    sys.stdout.write('\n'.join(summary) + '\n')
     
     sys.exit(0 if success else 1)
 